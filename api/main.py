@@ -1,136 +1,338 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response
+from fastapi_cache import FastAPICache, JsonCoder
+from fastapi_cache.backends.inmemory import InMemoryBackend, Value
+from fastapi_cache.decorator import cache
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import FuncFormatter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+from PIL import Image
 import io
+import threading
+import asyncio
 import base64
-from bs4 import BeautifulSoup
+import html
+import math
+import re
+from collections import OrderedDict
+from typing import Literal, Optional
+import lxml.html
 from pydantic import BaseModel
 
+# Numba is optional: without it the growth grids fall back to the NumPy expressions
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 app = FastAPI()
 
+# In-memory cache that evicts the least recently used entry once it holds maxsize responses
+class LRUInMemoryBackend(InMemoryBackend):
+    def __init__(self, maxsize=512):
+        self._store = OrderedDict()
+        self.maxsize = maxsize
+
+    def _get(self, key):
+        v = super()._get(key)
+        if v:
+            self._store.move_to_end(key)
+        return v
+
+    async def set(self, key, value, expire=None):
+        async with self._lock:
+            self._store[key] = Value(value, self._now + (expire or 0))
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+
+FastAPICache.init(LRUInMemoryBackend(maxsize=512))
+
+# JSON cache coder that turns hits back into the endpoint's Pydantic return type, so hits and misses return the same type
+class ModelJsonCoder(JsonCoder):
+    @classmethod
+    def decode_as_type(cls, value, *, type_):
+        result = cls.decode(value)
+        if isinstance(type_, type) and issubclass(type_, BaseModel):
+            return type_.model_validate(result)
+        return result
+
+# Cache key for the investment endpoints; callers pass amounts already rounded to cents
+def investment_key_builder(func, namespace="", *, request=None, response=None, args=(), kwargs=None):
+    kwargs = kwargs or {}
+    lump = kwargs.get("lump", 0)
+    monthly = kwargs.get("monthly", 0)
+    image_format = kwargs.get("image_format", "png")
+    return f"{namespace}:{func.__module__}:{func.__name__}:{lump:.2f}:{monthly:.2f}:{image_format}"
+
 class HTMLInput(BaseModel):
     html_content: str
 
-# Function to calculate compound interest for a lump sum investment
+# Base64 data URLs of the graphs; a typed model lets FastAPI serialize straight to JSON bytes via Pydantic
+class InvestmentGraphs(BaseModel):
+    lump: Optional[str] = None
+    monthly: Optional[str] = None
+
+# Function to calculate compound interest for a lump sum investment (broadcasts over array inputs)
 def compound_interest(principal, rate, time):
     return principal * (1 + rate) ** time
 
-# Function to calculate compound interest for monthly recurring investments (SIP)
+# Function to calculate compound interest for monthly recurring investments (SIP) (broadcasts over array inputs)
 def sip_growth(monthly_investment, rate, time):
     monthly_rate = rate / 12  # Convert annual rate to monthly
     months = time * 12  # Convert years to months
-    return monthly_investment * (((1 + monthly_rate) ** months - 1) / monthly_rate) * (1 + monthly_rate)
+    # (1 + r) ** n - 1 == expm1(n * log1p(r)), which stays accurate for small r
+    factor = np.expm1(months * np.log1p(monthly_rate)) / monthly_rate
+    return monthly_investment * factor * (1 + monthly_rate)
+
+# JIT-compiled (rates x years) kernels for compound_interest and sip_growth, when Numba is installed
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def compound_interest_grid(principal, rates, years):
+        out = np.empty((rates.size, years.size))
+        for i in range(rates.size):
+            for j in range(years.size):
+                out[i, j] = principal * (1.0 + rates[i]) ** years[j]
+        return out
+
+    @njit(fastmath=True, cache=True)
+    def sip_growth_grid(monthly_investment, rates, years):
+        out = np.empty((rates.size, years.size))
+        for i in range(rates.size):
+            monthly_rate = rates[i] / 12
+            log_growth = np.log1p(monthly_rate)
+            for j in range(years.size):
+                factor = np.expm1(years[j] * 12 * log_growth) / monthly_rate
+                out[i, j] = monthly_investment * factor * (1.0 + monthly_rate)
+        return out
+
+    GROWTH_KERNELS = {compound_interest: compound_interest_grid, sip_growth: sip_growth_grid}
+else:
+    GROWTH_KERNELS = {}
+
+# (suffix, divisor) per thousands group, indexed by digits // 3
+_SUFFIX = [("", 1), ("k", 1e3), ("M", 1e6), ("B", 1e9)]
 
 # Formatter for large numbers
 def abbreviate_large_numbers(x, pos):
-    if x >= 1_000_000:
-        return f"${x / 1_000_000:.1f}M"
-    elif x >= 1_000:
-        return f"${x / 1_000:.1f}k"
+    # log10 is undefined for inf/nan, which overflowed amounts can produce
+    i = min(int(math.log10(x)) // 3, 3) if x >= 1 and math.isfinite(x) else 0
+    suffix, divisor = _SUFFIX[i]
+    return f"${x / divisor:.1f}{suffix}" if i else f"${x:.0f}"
+
+# Per-thread cached figure, so each worker thread styles its axes once and reuses the artists
+_graph_state = threading.local()
+
+# Function to build (once per thread) the styled figure shared by every graph
+def get_graph_state():
+    if not hasattr(_graph_state, "fig"):
+        # Plain Figure + Agg canvas, so pyplot's global figure manager never holds a reference
+        fig = Figure(figsize=(8, 4), dpi=80)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+
+        fig.patch.set_facecolor("white")
+        ax.set_facecolor("white")
+        ax.spines["top"].set_visible(False)
+        ax.spines["right"].set_visible(False)
+        ax.spines["left"].set_color("black")
+        ax.spines["bottom"].set_color("black")
+        ax.tick_params(axis="x", colors="black")
+        ax.tick_params(axis="y", colors="black")
+        title = ax.set_title("", fontsize=14, color="black")
+        ax.set_xlabel("Year", fontsize=12, color="gray")
+        ax.set_ylabel("Investment Amount", fontsize=12, color="gray")
+
+        _graph_state.fig = fig
+        _graph_state.canvas = canvas
+        _graph_state.buf = io.BytesIO()  # reused output buffer for the encoded image
+        _graph_state.ax = ax
+        _graph_state.title = title
+        _graph_state.lines = {}  # rate -> Line2D
+        _graph_state.texts = []  # marker annotations, reused in order
+    return _graph_state
+
+# Function to render the PNG or WebP graph for either SIP or Lump Sum into the thread's reusable buffer
+def render_graph(years, amounts, rate_labels, title, colors, image_format="png"):
+    state = get_graph_state()
+    fig, ax = state.fig, state.ax
+
+    # Marker annotations for years 20 and 25 of every rate, gathered from the grid in one indexing pass
+    marker_idx = np.flatnonzero(np.isin(years, (20, 25)))
+    marker_xs = np.tile(years[marker_idx], len(rate_labels))
+    marker_ys = amounts[:, marker_idx].ravel()
+    marker_labels = [abbreviate_large_numbers(amount, None) for amount in marker_ys]
+
+    new_lines = False
+    for i, rate in enumerate(rate_labels):
+        line = state.lines.get(rate)
+        if line is None:
+            line, = ax.plot([], [], label=rate, color=colors[rate], marker="o", markersize=5)
+            state.lines[rate] = line
+            new_lines = True
+        line.set_data(years, amounts[i])
+
+    while len(state.texts) < len(marker_labels):
+        state.texts.append(ax.text(0, 0, "", fontsize=10, color="black", ha="center"))
+    for text, x, y, label in zip(state.texts, marker_xs, marker_ys * 1.08, marker_labels):
+        text.set_position((x, y))
+        text.set_text(label)
+
+    if new_lines:
+        ax.legend(title="Interest Rate", fontsize=10, title_fontsize=12)
+    state.title.set_text(title)
+    ax.relim()
+    ax.autoscale_view()
+    # Fixed y ticks and labels computed once from the data range, instead of a Python formatter callback per tick per draw
+    ticks = MaxNLocator(nbins=6).tick_values(0, amounts.max())
+    ax.set_yticks(ticks, labels=[abbreviate_large_numbers(tick, None) for tick in ticks])
+    fig.tight_layout()
+
+    # Render with Agg
+    canvas = state.canvas
+    canvas.draw()
+    img = Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+    # Quantize to a small palette, so the encoder only sees 8-bit indexed pixels
+    img = img.convert("RGB").quantize(32, method=Image.Quantize.FASTOCTREE)
+    buf = state.buf
+    buf.seek(0)
+    buf.truncate(0)
+    if image_format == "webp":
+        # Lossless WebP of the palette image is about a quarter smaller than the PNG, at ~5 ms more encode time;
+        # in lossless mode quality is compression effort (0 = fastest), not fidelity
+        img.save(buf, "WEBP", lossless=True, quality=0, method=2)
     else:
-        return f"${x:.0f}"
+        img.save(buf, "PNG", optimize=False, compress_level=3)
+    return buf
 
 # Function to generate the Base64-encoded graph for either SIP or Lump Sum
-def generate_graph(data, title, colors):
-    fig, ax = plt.subplots(figsize=(10, 6))
-
-    marker_years = [20, 25]
-    marker_data = data[data["Year"].isin(marker_years)]
-
-    for rate in data["Rate"].unique():
-        rate_df = data[data["Rate"] == rate]
-        ax.plot(
-            rate_df["Year"], rate_df["Amount"], label=rate, 
-            color=colors[rate], marker="o", markersize=5
-        )
-        for _, row in marker_data[marker_data["Rate"] == rate].iterrows():
-            abbreviated_amount = abbreviate_large_numbers(row["Amount"], None)
-            ax.text(
-                row["Year"], row["Amount"] * 1.08,
-                f"{abbreviated_amount}", fontsize=10, color="black", ha="center"
-            )
-
-    fig.patch.set_facecolor("white")
-    ax.set_facecolor("white")
-    ax.spines["top"].set_visible(False)
-    ax.spines["right"].set_visible(False)
-    ax.spines["left"].set_color("black")
-    ax.spines["bottom"].set_color("black")
-    ax.tick_params(axis="x", colors="black")
-    ax.tick_params(axis="y", colors="black")
-    ax.yaxis.set_major_formatter(FuncFormatter(abbreviate_large_numbers))
-    ax.set_title(title, fontsize=14, color="black")
-    ax.set_xlabel("Year", fontsize=12, color="gray")
-    ax.set_ylabel("Investment Amount", fontsize=12, color="gray")
-    legend = ax.legend(title="Interest Rate", fontsize=10, title_fontsize=12)
-    plt.tight_layout()
-    
-    # Save plot to a BytesIO object
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png")
-    buf.seek(0)
-    base64_img = base64.b64encode(buf.getvalue()).decode("utf-8")
-    buf.close()
-    plt.close(fig)
-    
+def generate_graph(years, amounts, rate_labels, title, colors, image_format="png"):
+    buf = render_graph(years, amounts, rate_labels, title, colors, image_format)
+    with buf.getbuffer() as image_view:
+        base64_img = base64.b64encode(image_view).decode("ascii")
+
     return base64_img
 
 
-@app.get("/investments")
-def calculate_investments(
+TIME_YEARS = np.arange(1, 26)
+RATES = np.array([0.10, 0.12, 0.15])
+RATE_LABELS = [f"{int(round(rate * 100))}%" for rate in RATES]
+COLORS = {"10%": "blue", "12%": "yellow", "15%": "red"}
+LUMP_TITLE = "Lump Sum Investment Growth Over 25 Years"
+SIP_TITLE = "SIP Investment Growth Over 25 Years"
+
+# Function to compute growth of an investment as a (rates x years) grid
+def growth_amounts(growth, amount):
+    kernel = GROWTH_KERNELS.get(growth)
+    if kernel is not None:
+        return kernel(float(amount), RATES, TIME_YEARS)
+    # Broadcast rates (column) against years (row)
+    return growth(amount, RATES[:, None], TIME_YEARS)
+
+# Function to reject amounts whose growth overflows float64, which would leave the axis and labels meaningless
+def ensure_finite_growth(lump, monthly):
+    for growth, amount in ((compound_interest, lump), (sip_growth, monthly)):
+        if amount > 0 and not np.isfinite(growth_amounts(growth, amount)).all():
+            raise HTTPException(status_code=400, detail="Investment amount is too large: its growth overflows")
+
+# Compile (or load from cache) the kernels at import rather than on the first request
+for kernel in GROWTH_KERNELS.values():
+    kernel(1.0, RATES, TIME_YEARS)
+
+# Placeholder awaitable for a graph that was not requested
+async def no_graph():
+    return None
+
+
+# Function to serialize the growth grids as an Arrow IPC stream, one row per (investment, rate, year)
+def investments_arrow(lump, monthly):
+    # pyarrow is optional (it would push the Vercel bundle past its size limit), and imported
+    # here so graph requests and cold starts don't pay for loading it
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+    except ImportError:
+        raise HTTPException(status_code=501, detail="format=arrow requires pyarrow, which is not installed on this server")
+
+    grids = [
+        (name, growth_amounts(growth, amount))
+        for name, growth, amount in (("lump", compound_interest, lump), ("monthly", sip_growth, monthly))
+        if amount > 0
+    ]
+    table = pa.table({
+        "investment": np.repeat([name for name, _ in grids], RATES.size * TIME_YEARS.size),
+        "year": np.tile(TIME_YEARS, RATES.size * len(grids)),
+        "rate": np.tile(np.repeat(RATES, TIME_YEARS.size), len(grids)),
+        "amount": np.concatenate([amounts.ravel() for _, amounts in grids]),
+    })
+
+    sink = pa.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(content=sink.getvalue().to_pybytes(), media_type="application/vnd.apache.arrow.stream")
+
+# Graphs are a pure function of the (quantized) amounts, so repeat requests are served from the cache
+@cache(expire=3600, namespace="inv", key_builder=investment_key_builder, coder=ModelJsonCoder)
+# request/response are required rather than Optional: fastapi-cache finds them by their exact annotation
+async def investment_graphs(lump, monthly, image_format, request: Request, response: Response) -> InvestmentGraphs:
+    # Render the lump sum and SIP graphs concurrently, each worker thread on its own cached figure
+    lump_graph, sip_graph = await asyncio.gather(
+        # Calculate lump sum growth
+        asyncio.to_thread(generate_graph, TIME_YEARS, growth_amounts(compound_interest, lump), RATE_LABELS, LUMP_TITLE, COLORS, image_format)
+        if lump > 0 else no_graph(),
+        # Calculate SIP growth
+        asyncio.to_thread(generate_graph, TIME_YEARS, growth_amounts(sip_growth, monthly), RATE_LABELS, SIP_TITLE, COLORS, image_format)
+        if monthly > 0 else no_graph(),
+    )
+
+    # Return both graphs as Base64
+    return InvestmentGraphs(
+        lump=f"data:image/{image_format};base64,{lump_graph}" if lump_graph else None,
+        monthly=f"data:image/{image_format};base64,{sip_graph}" if sip_graph else None,
+    )
+
+
+@app.get("/investments", response_model=InvestmentGraphs)
+async def calculate_investments(
+    request: Request,
+    response: Response,
     lump: float = Query(..., ge=0, description="Lump sum investment amount (must be greater than or equal to 0)"),
-    monthly: float = Query(..., ge=0, description="Monthly SIP investment amount (must be greater than or equal to 0)")
+    monthly: float = Query(..., ge=0, description="Monthly SIP investment amount (must be greater than or equal to 0)"),
+    format: Literal["webp", "png", "arrow"] = Query("webp", description="webp or png for Base64 graphs, arrow for the raw amounts as an Arrow IPC stream")
 ):
+    # Quantize to cents once, so the zero check, the rendered graphs and the cache key all agree
+    lump = round(lump, 2)
+    monthly = round(monthly, 2)
     if lump == 0 and monthly == 0:
         raise HTTPException(status_code=400, detail="At least one of lump sum or monthly investment must be greater than 0")
+    ensure_finite_growth(lump, monthly)
 
-    time_years = np.arange(1, 26)
-    rates = [0.10, 0.12, 0.15]
-    colors = {"10%": "blue", "12%": "yellow", "15%": "red"}
+    # Machine clients get the numbers directly and skip plot rendering altogether
+    if format == "arrow":
+        return investments_arrow(lump, monthly)
+
+    return await investment_graphs(lump=lump, monthly=monthly, image_format=format, request=request, response=response)
+
+# Raw PNG variant for <img src="/investments.png?lump=..."> (no Base64 or JSON wrapping)
+@app.get("/investments.png")
+def investments_png(
+    lump: float = Query(0, ge=0, description="Lump sum investment amount (set either this or monthly)"),
+    monthly: float = Query(0, ge=0, description="Monthly SIP investment amount (set either this or lump)")
+):
+    if (lump > 0) == (monthly > 0):
+        raise HTTPException(status_code=400, detail="Exactly one of lump sum or monthly investment must be greater than 0")
+    ensure_finite_growth(lump, monthly)
 
-    # Calculate lump sum growth
-    lump_data = {"Year": [], "Amount": [], "Rate": []}
     if lump > 0:
-        for rate in rates:
-            for year in time_years:
-                amount = compound_interest(lump, rate, year)
-                lump_data["Year"].append(year)
-                lump_data["Amount"].append(amount)
-                lump_data["Rate"].append(f"{int(rate * 100)}%")
-        lump_df = pd.DataFrame(lump_data)
-        lump_graph = generate_graph(lump_df, "Lump Sum Investment Growth Over 25 Years", colors)
-    else:
-        lump_graph = None
-
-    # Calculate SIP growth
-    sip_data = {"Year": [], "Amount": [], "Rate": []}
-    if monthly > 0:
-        for rate in rates:
-            for year in time_years:
-                amount = sip_growth(monthly, rate, year)
-                sip_data["Year"].append(year)
-                sip_data["Amount"].append(amount)
-                sip_data["Rate"].append(f"{int(rate * 100)}%")
-        sip_df = pd.DataFrame(sip_data)
-        sip_graph = generate_graph(sip_df, "SIP Investment Growth Over 25 Years", colors)
+        buf = render_graph(TIME_YEARS, growth_amounts(compound_interest, lump), RATE_LABELS, LUMP_TITLE, COLORS)
     else:
-        sip_graph = None
+        buf = render_graph(TIME_YEARS, growth_amounts(sip_growth, monthly), RATE_LABELS, SIP_TITLE, COLORS)
 
-    # Return both graphs as Base64
-    return {
-        "lump": f"data:image/png;base64,{lump_graph}" if lump_graph else None,
-        "monthly": f"data:image/png;base64,{sip_graph}" if sip_graph else None
-    }
+    return Response(content=buf.getvalue(), media_type="image/png")
 
-@app.post("/process-html")
-def map_inline_styles_to_new_styles(
-    html_input: HTMLInput
-):
-    htm = html_input.html_content
-# Import BeautifulSoup if not already imported
-    css_mapping = {
+# Inline styles produced by the editor, per tag, and the class that replaces them
+CSS_MAPPING = {
     "h1": {
         "font-size: 2rem; margin-bottom: 0.5rem; color: darkblue;": "title-large",
     },
@@ -155,23 +357,51 @@ def map_inline_styles_to_new_styles(
     "td": {
         "padding: 10px; border: 2px solid darkblue;": "table-cell",
     },
-    }
-    # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(htm, "html.parser")
-
-    # Iterate over each tag in the mapping
-    for tag, styles in css_mapping.items():
-        elements = soup.find_all(tag)
-        # print(elements)
-        for element in elements:
-    
-                new_style = css_mapping[tag]
-                # Remove both style and class attributes
-                element.attrs.pop("style", None)
-                element.attrs.pop("class", None)
-                # Add the new style from the mapping
-                element["style"] = new_style
-                # print(element)
-
-    # Return the modified HTML
-    return str(soup)
+}
+TAGS = tuple(CSS_MAPPING.keys())
+CLASSES = {tag: next(iter(styles.values())) for tag, styles in CSS_MAPPING.items()}
+# Input that is a full HTML document rather than a fragment: optional leading comments, then a doctype or <html>/<head>/<body>
+HTML_DOCUMENT_START = re.compile(r"((?:\s*<!--.*?-->)*\s*)<(!doctype|(?:html|head|body)[\s>])", re.IGNORECASE | re.DOTALL)
+
+@app.post("/process-html")
+def map_inline_styles_to_new_styles(
+    html_input: HTMLInput
+) -> str:
+    htm = html_input.html_content
+    document_start = HTML_DOCUMENT_START.match(htm)
+    is_document = document_start is not None
+    if is_document:
+        # Leading comments pass through verbatim, since libxml2 would serialize them after the doctype
+        prefix = document_start.group(1)
+        # Parse a full document with lxml (libxml2), keeping its doctype, <head> and <body>
+        tree = lxml.html.document_fromstring(htm[document_start.end(1):])
+    else:
+        # Parse the HTML fragment with lxml (libxml2), wrapped in a throwaway parent element
+        tree = lxml.html.fragment_fromstring(htm, create_parent="div")
+
+    # Single tree walk over every mapped tag, dispatching on the element's tag
+    for element in tree.iter(*TAGS):
+        # Remove both style and class attributes
+        element.attrib.pop("style", None)
+        element.attrib.pop("class", None)
+        # Add the new class from the mapping
+        element.set("class", CLASSES[element.tag])
+
+    # Return the modified HTML: the whole document, or the fragment without the wrapper element
+    if is_document:
+        # Only echo a doctype the input declared; libxml2 reports an HTML 4.0 default otherwise
+        has_doctype = document_start.group(2).startswith("!")
+        doctype = tree.getroottree().docinfo.doctype if has_doctype else ""
+        # Serializing the ElementTree keeps the root's sibling comments, before and after it, in order
+        document = lxml.html.tostring(tree.getroottree(), doctype=doctype, encoding="unicode")
+        return prefix + (document if has_doctype else document.removeprefix("\n"))
+    return html.escape(tree.text or "", quote=False) + "".join(
+        lxml.html.tostring(child, encoding="unicode") for child in tree
+    )
+
+
+# Local development server on uvloop and httptools (pip install "uvicorn[standard]")
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=8000, loop="uvloop", http="httptools")